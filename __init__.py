@@ -7,12 +7,17 @@ Refresh cache with 'gh refresh cache'.
 """
 
 import os
-import json
+import bisect
+import orjson
 import keyring
+import tempfile
+import threading
+from collections import namedtuple
 from albert import *
 from pathlib import Path
+from functools import partial
 from github import Github
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 
 md_iid = '2.0'
 md_version = "1.1"
@@ -21,10 +26,17 @@ md_description = "Open GitHub user repositories in the browser"
 md_license = "GPL-3.0"
 md_url = "https://github.com/aironskin/albert-github"
 md_maintainers = "@aironskin"
-md_lib_dependencies = ["github", "rapidfuzz", "keyring"]
+md_lib_dependencies = ["github", "rapidfuzz", "keyring", "orjson"]
 
 plugin_dir = os.path.dirname(__file__)
 CACHE_FILE = os.path.join(plugin_dir, "repository_cache.json")
+MAX_RESULTS = 50
+
+# Repositories in struct-of-arrays layout, the first four fields are parallel
+# lists; sorted_keys holds the lowercased names in sorted order for prefix
+# lookups and sorted_indices maps them back to repository indices
+Repos = namedtuple("Repos", ["names", "names_lower", "full_names", "html_urls",
+                             "sorted_keys", "sorted_indices"])
 
 
 class Plugin(PluginInstance, TriggerQueryHandler):
@@ -37,6 +49,11 @@ class Plugin(PluginInstance, TriggerQueryHandler):
                                      defaultTrigger='gh ')
         PluginInstance.__init__(self, extensions=[self])
         self.iconUrls = [f"file:{Path(__file__).parent}/plugin.svg"]
+        self._repos = None
+        self._cache_mtime = 0
+        self._cache_lock = threading.RLock()
+        self._fetch_thread = None
+        self._last_search = None
 
     def save_token(self, token):
         # Save the token in the keyring
@@ -48,13 +65,14 @@ class Plugin(PluginInstance, TriggerQueryHandler):
 
     def get_user_repositories(self, token):
         # Fetch user repositories from GitHub using the provided token
-        g = Github(token)
+        g = Github(token, per_page=100)
         user = g.get_user()
         repositories = []
         for repo in user.get_repos():
             repositories.append(
                 {
                     "name": repo.name,
+                    "name_lower": repo.name.lower(),
                     "full_name": repo.full_name,
                     "html_url": repo.html_url,
                 }
@@ -62,30 +80,100 @@ class Plugin(PluginInstance, TriggerQueryHandler):
         return repositories
 
     def cache_repositories(self, repositories):
-        # Cache the repositories on the file system
-        with open(CACHE_FILE, "w") as file:
-            json.dump(repositories, file)
+        # Cache the repositories on the file system, replacing the file
+        # atomically so concurrent readers never see a partial write
+        fd, tmp_path = tempfile.mkstemp(dir=plugin_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(orjson.dumps(repositories))
+                file.flush()
+                mtime = os.fstat(file.fileno()).st_mtime
+            with self._cache_lock:
+                os.replace(tmp_path, CACHE_FILE)
+                self._set_repositories(repositories, mtime)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def refresh_cache(self, token):
+        # Fetch and cache the repositories without blocking the UI
+        with self._cache_lock:
+            if self._fetch_thread and self._fetch_thread.is_alive():
+                return
+            self._fetch_thread = threading.Thread(target=self._fetch_and_cache, args=(token,), daemon=True)
+            self._fetch_thread.start()
+
+    def _fetch_and_cache(self, token):
+        try:
+            self.cache_repositories(self.get_user_repositories(token))
+        except Exception as e:
+            warning(f"Failed to refresh repository cache: {e}")
+
+    def _set_repositories(self, repositories, mtime):
+        # Keep the parsed repositories in memory until the cache file changes
+        names_lower = [repo["name_lower"] for repo in repositories]
+        sorted_lower = sorted(enumerate(names_lower), key=lambda t: t[1])
+        with self._cache_lock:
+            self._repos = Repos(names=[repo["name"] for repo in repositories],
+                                names_lower=names_lower,
+                                full_names=[repo["full_name"] for repo in repositories],
+                                html_urls=[repo["html_url"] for repo in repositories],
+                                sorted_keys=[t[1] for t in sorted_lower],
+                                sorted_indices=[t[0] for t in sorted_lower])
+            self._last_search = None
+            self._cache_mtime = mtime
 
     def load_cached_repositories(self):
         # Load the cached repositories from the file if it exists
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "r") as file:
-                return json.load(file)
-        return None
+        with self._cache_lock:
+            return self._load_cached_repositories()
+
+    def _load_cached_repositories(self):
+        try:
+            st = os.stat(CACHE_FILE)
+        except FileNotFoundError:
+            return None
+        if st.st_mtime != self._cache_mtime:
+            with open(CACHE_FILE, "rb") as file:
+                repositories = orjson.loads(file.read())
+            # Caches written by older versions lack the lowercased name
+            for repo in repositories:
+                if "name_lower" not in repo:
+                    repo["name_lower"] = repo["name"].lower()
+            self._set_repositories(repositories, st.st_mtime)
+        return self._repos
+
+    def _scorer(self, search_term):
+        # Single token queries skip the tokenization of token_set_ratio
+        return fuzz.ratio if " " not in search_term else fuzz.token_set_ratio
 
     def fuzzy_search_repositories(self, repositories, search_string):
-        # Perform fuzzy search on the repositories
-        matching_repos = []
-        for repo in repositories:
-            repo_name = repo["name"]
-            ratio = fuzz.token_set_ratio(
-                repo_name.lower(), search_string.lower())
-            if ratio >= 75:
-                matching_repos.append(repo)
-        return matching_repos
+        # Perform fuzzy search on the repositories, returning matching indices
+        search_term = search_string.lower()
+        matches = process.extract(search_term, repositories.names_lower,
+                                  scorer=self._scorer(search_term), processor=None,
+                                  score_cutoff=75, limit=None)
+        return [index for _, _, index in matches]
+
+    def _make_item(self, repositories, index, exact=False):
+        # Build the result item opening the repository in the browser
+        open_url = partial(openUrl, repositories.html_urls[index])
+        if exact:
+            action = Action("eopen", "Open exact match", open_url)
+        else:
+            action = Action("fopen", "Open fuzzy match", open_url)
+        return StandardItem(id=md_id,
+                            text=repositories.names[index],
+                            iconUrls=self.iconUrls,
+                            subtext=repositories.full_names[index],
+                            actions=[action])
 
     def handleTriggerQuery(self, query):
 
+        query_stripped = query.string.strip()
+        search_term = query_stripped.lower()
+
         # Load GitHub user token
         token = self.load_token()
         if not token:
@@ -93,64 +181,72 @@ class Plugin(PluginInstance, TriggerQueryHandler):
                                    text=md_name,
                                    iconUrls=self.iconUrls,
                                    subtext="Paste your GitHub token and press [enter] to save it",
-                                   actions=[Action("save", "Save token", lambda t=query.string.strip(): self.save_token(t))]))
+                                   actions=[Action("save", "Save token", lambda t=query_stripped: self.save_token(t))]))
+            return
 
         # Load the repositories from cache or fetch them from GitHub
         repositories = self.load_cached_repositories()
-        if not repositories:
+        if not repositories or not repositories.names:
             query.add(StandardItem(id=md_id,
                                    text=md_name,
                                    iconUrls=self.iconUrls,
-                                   subtext="Press [enter] to initialize the repository cache (may take a few seconds)",
-                                   actions=[Action("cache", "Create repository cache", lambda: self.cache_repositories(self.get_user_repositories(token)))]))
-
-        query_stripped = query.string.strip()
+                                   subtext="Press [enter] to initialize the repository cache (runs in the background)",
+                                   actions=[Action("cache", "Create repository cache", lambda: self.refresh_cache(token))]))
 
         if query_stripped:
 
             # Refresh local repositories cache
-            if query_stripped.lower() == "refresh cache":
+            if search_term == "refresh cache":
                 query.add(StandardItem(id=md_id,
                                        text=md_name,
                                        iconUrls=self.iconUrls,
-                                       subtext="Press [enter] to refresh the local repository cache (may take a few seconds)",
-                                       actions=[Action("refresh", "Refresh repository cache", lambda: self.cache_repositories(self.get_user_repositories(token)))]))
+                                       subtext="Press [enter] to refresh the local repository cache (runs in the background)",
+                                       actions=[Action("refresh", "Refresh repository cache", lambda: self.refresh_cache(token))]))
+                return
 
-            if not repositories:
-                return []
+            if not repositories or not repositories.names:
+                return
 
-            # Fuzzy search the query in repository names
-            search_term = query.string.strip().lower()
-            exact_matches = []
-            fuzzy_matches = []
+            # Substring hits of an extended query are a subset of the previous
+            # prefix and substring hits, so only those need rechecking
+            names_lower = repositories.names_lower
+            substring_pool = range(len(names_lower))
+            last_search = self._last_search
+            if last_search:
+                last_repositories, last_term, last_hits = last_search
+                if last_repositories is repositories and search_term.startswith(last_term):
+                    substring_pool = last_hits
 
-            for repo in repositories:
-                repo_name = repo["name"]
-                if repo_name.lower().startswith(search_term):
-                    exact_matches.append(repo)
-                else:
-                    similarity_ratio = fuzz.token_set_ratio(
-                        repo_name.lower(), search_term)
-                    if similarity_ratio > 25:
-                        fuzzy_matches.append((repo, similarity_ratio))
-
-            # Sort the fuzzy matches based on similarity ratio
-            fuzzy_matches.sort(key=lambda x: x[1], reverse=True)
-
-            results = []
-            for repo in exact_matches:
-                results.append(StandardItem(id=md_id,
-                                            text=repo["name"],
-                                            iconUrls=self.iconUrls,
-                                            subtext=repo["full_name"],
-                                            actions=[Action("eopen", "Open exact match", lambda u=repo["html_url"]: openUrl(u))]))
-
-            for repo, similarity_ratio in fuzzy_matches:
-                results.append(StandardItem(id=md_id,
-                                            text=repo["name"],
-                                            iconUrls=self.iconUrls,
-                                            subtext=repo["full_name"],
-                                            actions=[Action("fopen", "Open fuzzy match", lambda u=repo["html_url"]: openUrl(u))]))
+            # Binary search the prefix matches in the sorted names, these are
+            # scored 101 so they rank above every fuzzy match
+            sorted_keys = repositories.sorted_keys
+            matches = []
+            i = bisect.bisect_left(sorted_keys, search_term)
+            while i < len(sorted_keys) and sorted_keys[i].startswith(search_term):
+                matches.append((repositories.sorted_indices[i], 101))
+                i += 1
+            hit_set = {index for index, _ in matches}
+
+            for index in substring_pool:
+                if index not in hit_set and search_term in names_lower[index]:
+                    matches.append((index, 90))
+                    hit_set.add(index)
+            self._last_search = (repositories, search_term, sorted(hit_set))
+
+            # Only run the expensive scorer when the cheap buckets yield few hits,
+            # always over every remaining repository name
+            if len(matches) < 20:
+                candidates = {index: name for index, name in enumerate(names_lower)
+                              if index not in hit_set}
+                matches += [(index, similarity_ratio)
+                            for _, similarity_ratio, index in process.extract(
+                                search_term, candidates,
+                                scorer=self._scorer(search_term), processor=None,
+                                score_cutoff=25, limit=MAX_RESULTS)]
+
+            matches.sort(key=lambda x: x[1], reverse=True)
+            results = [self._make_item(repositories, index, exact=similarity_ratio > 100)
+                       for index, similarity_ratio in matches[:MAX_RESULTS]]
 
             if results:
                 query.add(results)